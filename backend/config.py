@@ -9,9 +9,20 @@ MODEL_PATH = os.environ.get("MODEL_PATH", "./models/wav2lip_gan.pth")
 MAX_FILE_SIZE_MB = int(os.environ.get("MAX_FILE_SIZE_MB", "50"))
 DEFAULT_TTS_VOICE = os.environ.get("DEFAULT_TTS_VOICE", "en-US-GuyNeural")
 
+# job:{id} state and the task:{id} index expire this long after their last write
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "86400"))
+
+# Content-addressed cache of synthesised speech, keyed by (voice, text).
+# Entries unused for TTS_CACHE_MAX_AGE_DAYS are pruned, oldest first beyond
+# TTS_CACHE_MAX_MB.
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", os.path.join(TEMP_DIR, "tts_cache"))
+TTS_CACHE_MAX_MB = int(os.environ.get("TTS_CACHE_MAX_MB", "500"))
+TTS_CACHE_MAX_AGE_DAYS = int(os.environ.get("TTS_CACHE_MAX_AGE_DAYS", "7"))
+
 # Wav2Lip repo path (relative to project root)
 WAV2LIP_DIR = os.environ.get("WAV2LIP_DIR", "./wav2lip")
 
 # Ensure working directories exist
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(TTS_CACHE_DIR, exist_ok=True)
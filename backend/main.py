@@ -1,29 +1,39 @@
 """FastAPI application — meme lip-sync generator."""
 
-import json
+import asyncio
+import functools
 import logging
 import os
+import shutil
 import uuid
 from pathlib import Path
 
-import aiofiles
-from fastapi import FastAPI, File, HTTPException, UploadFile
+import redis.asyncio as aioredis
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from pydantic import BaseModel
 
-from backend.config import MAX_FILE_SIZE_MB, OUTPUT_DIR, REDIS_URL, TEMP_DIR
-from backend.tasks import celery_app, process_meme
+from backend.config import JOB_TTL_SECONDS, MAX_FILE_SIZE_MB, OUTPUT_DIR, REDIS_URL, TEMP_DIR
+from backend.tasks import celery_app
 
 from fastapi.staticfiles import StaticFiles
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB per read while streaming uploads to disk
+
 # Resolve frontend directory relative to this file
 FRONTEND_DIR = Path(__file__).resolve().parent.parent / "frontend"
 
-app = FastAPI(title="Meme Lip-Sync Generator", version="1.0.0")
+# orjson serialises straight to bytes in C; /status is polled every few
+# seconds per client, so it is the hottest encode path in the API
+app = FastAPI(
+    title="Meme Lip-Sync Generator",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,20 +44,79 @@ app.add_middleware(
 
 # ── Redis helpers ─────────────────────────────────────────────────────────────
 
-def _get_redis():
-    import redis
-    return redis.from_url(REDIS_URL)
+@functools.lru_cache(maxsize=1)
+def _get_redis() -> aioredis.Redis:
+    """Return the process-wide asyncio Redis client (one shared connection pool)."""
+    return aioredis.Redis.from_url(
+        REDIS_URL,
+        decode_responses=False,
+        max_connections=64,
+        socket_keepalive=True,
+    )
+
 
+def _encode_job_state(state: dict) -> dict:
+    """Flatten a job state dict into Redis hash fields (None → empty string)."""
+    return {k: "" if v is None else v for k, v in state.items()}
 
-def _get_job_state(job_id: str) -> dict | None:
-    r = _get_redis()
-    raw = r.get(f"job:{job_id}")
-    return json.loads(raw) if raw else None
+
+def _decode_job_state(raw: dict) -> dict:
+    """Inverse of _encode_job_state for an HGETALL reply."""
+    state = {k.decode(): v.decode() or None for k, v in raw.items()}
+    if state.get("progress") is not None:
+        state["progress"] = int(state["progress"])
+    return state
 
 
-def _set_job_state(job_id: str, state: dict) -> None:
+async def _get_job_state(job_id: str) -> dict | None:
     r = _get_redis()
-    r.set(f"job:{job_id}", json.dumps(state))
+    raw = await r.hgetall(f"job:{job_id}")
+    return _decode_job_state(raw) if raw else None
+
+
+async def _set_job_state(job_id: str, state: dict) -> None:
+    # Every write refreshes the TTL, so a job expires JOB_TTL_SECONDS after
+    # its last state change; HSET and EXPIRE share one round-trip
+    key = f"job:{job_id}"
+    pipe = _get_redis().pipeline(transaction=False)
+    pipe.hset(key, mapping=_encode_job_state(state))
+    pipe.expire(key, JOB_TTL_SECONDS)
+    await pipe.execute()
+
+
+# ── Upload helpers ────────────────────────────────────────────────────────────
+
+def _write_upload(src, path: str, max_bytes: int) -> int:
+    """
+    Copy an uploaded file object to path in bounded chunks.
+
+    Runs in a worker thread. Stops as soon as more than max_bytes have been
+    read and returns the number of bytes read so the caller can reject it.
+    """
+    size_bytes = 0
+    with open(path, "wb") as f:
+        while chunk := src.read(UPLOAD_CHUNK_SIZE):
+            size_bytes += len(chunk)
+            if size_bytes > max_bytes:
+                break
+            f.write(chunk)
+    return size_bytes
+
+
+# ── File responses ────────────────────────────────────────────────────────────
+
+def _cached_file_response(request: Request, path: str, **kwargs) -> Response:
+    """
+    Serve path with an mtime/size ETag, answering a matching If-None-Match
+    with 304 Not Modified and no body.
+    """
+    st = os.stat(path)
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers, stat_result=st, **kwargs)
 
 
 # ── Request/response models ───────────────────────────────────────────────────
@@ -81,27 +150,26 @@ async def upload_file(file: UploadFile = File(...)):
             detail=f"Unsupported file type '{suffix}'. Upload a GIF or MP4.",
         )
 
-    # Read first chunk to check size without loading the whole file
-    content = await file.read()
-    max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
-    if len(content) > max_bytes:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File too large. Maximum size is {MAX_FILE_SIZE_MB} MB.",
-        )
-
     job_id = str(uuid.uuid4())
     job_dir = os.path.join(TEMP_DIR, job_id)
-    os.makedirs(job_dir, exist_ok=True)
+    os.mkdir(job_dir)  # TEMP_DIR exists (config.py) and job_id is fresh
 
     input_filename = f"upload{suffix}"
     input_path = os.path.join(job_dir, input_filename)
 
-    async with aiofiles.open(input_path, "wb") as f:
-        await f.write(content)
+    # Stream to disk in bounded chunks, aborting as soon as the cap is exceeded
+    max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+    size_bytes = await asyncio.to_thread(_write_upload, file.file, input_path, max_bytes)
+
+    if size_bytes > max_bytes:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {MAX_FILE_SIZE_MB} MB.",
+        )
 
     # Store initial job state
-    _set_job_state(job_id, {
+    await _set_job_state(job_id, {
         "status": "uploaded",
         "progress": 0,
         "output_url": None,
@@ -111,21 +179,23 @@ async def upload_file(file: UploadFile = File(...)):
 
     preview_url = f"/output/preview/{job_id}{suffix}"
 
-    logger.info("Uploaded job %s: %s (%d bytes)", job_id, file.filename, len(content))
+    logger.info("Uploaded job %s: %s (%d bytes)", job_id, file.filename, size_bytes)
 
-    return JSONResponse({
+    return ORJSONResponse({
         "job_id": job_id,
         "preview_url": preview_url,
         "filename": file.filename,
-        "size_bytes": len(content),
+        "size_bytes": size_bytes,
     })
 
 
-@app.get("/output/preview/{job_id}{suffix}")
-async def get_preview(job_id: str, suffix: str):
+@app.get("/output/preview/{name}")
+async def get_preview(request: Request, name: str):
     """Serve the uploaded file for preview in the frontend."""
-    # Reconstruct the file path from job_id
-    job_state = _get_job_state(job_id)
+    # name is "<job_id><suffix>"; a "{job_id}{suffix}" route cannot split it,
+    # since the first parameter greedily takes all but the last character
+    job_id = name.partition(".")[0]
+    job_state = await _get_job_state(job_id)
     if not job_state:
         raise HTTPException(status_code=404, detail="Job not found.")
 
@@ -133,7 +203,7 @@ async def get_preview(job_id: str, suffix: str):
     if not input_path or not os.path.exists(input_path):
         raise HTTPException(status_code=404, detail="Preview file not found.")
 
-    return FileResponse(input_path)
+    return _cached_file_response(request, input_path)
 
 
 @app.post("/generate")
@@ -150,23 +220,36 @@ async def generate(request: GenerateRequest):
     if len(request.text) > 200:
         raise HTTPException(status_code=400, detail="Text must be 200 characters or fewer.")
 
-    job_state = _get_job_state(request.job_id)
+    job_state = await _get_job_state(request.job_id)
     if not job_state:
         raise HTTPException(status_code=404, detail=f"Job {request.job_id} not found.")
 
-    task = process_meme.apply_async(
-        args=[request.job_id, request.text],
-        task_id=str(uuid.uuid4()),
-    )
+    task_id = str(uuid.uuid4())
 
-    # Update job state to record task_id
-    job_state["task_id"] = task.id
-    job_state["status"] = "queued"
-    _set_job_state(request.job_id, job_state)
+    # Record task_id and the task → job index before enqueueing so the worker
+    # never races with this write and /status can resolve the job immediately
+    r = _get_redis()
+    pipe = r.pipeline(transaction=False)
+    pipe.hset(f"job:{request.job_id}", mapping={"task_id": task_id, "status": "queued"})
+    pipe.expire(f"job:{request.job_id}", JOB_TTL_SECONDS)
+    pipe.set(f"task:{task_id}", request.job_id, ex=JOB_TTL_SECONDS)
+    await pipe.execute()
+
+    # send_task publishes by name; run it off the event loop since the broker
+    # client is blocking. The API never sees the task decorator, so
+    # ignore_result is repeated here; without it the result backend
+    # subscribes to a result channel for every task that never publishes.
+    task = await asyncio.to_thread(
+        celery_app.send_task,
+        "process_meme",
+        args=[request.job_id, request.text, job_state.get("input_path")],
+        task_id=task_id,
+        ignore_result=True,
+    )
 
     logger.info("Started task %s for job %s", task.id, request.job_id)
 
-    return JSONResponse({"task_id": task.id, "job_id": request.job_id})
+    return ORJSONResponse({"task_id": task.id, "job_id": request.job_id})
 
 
 @app.get("/status/{task_id}")
@@ -174,65 +257,78 @@ async def get_status(task_id: str):
     """
     Return the current status of a Celery task.
 
-    The job state is stored in Redis under the job_id, so we look up the
-    task → job_id mapping via Celery's result backend.
+    The job state is stored in Redis under the job_id; /generate writes a
+    task:{task_id} → job_id index so the lookup is two O(1) GETs.
     """
-    result = celery_app.AsyncResult(task_id)
-
-    # Try to find job state from Redis by scanning for task_id
     r = _get_redis()
-    job_state = None
-    # Celery result backend stores task state independently; we scan job keys
-    for key in r.scan_iter("job:*"):
-        raw = r.get(key)
-        if not raw:
-            continue
-        state = json.loads(raw)
-        if state.get("task_id") == task_id:
-            job_state = state
-            break
-
-    if job_state is None:
-        # Fall back to Celery result status
-        celery_status = result.status
-        if celery_status == "PENDING":
-            return JSONResponse({
-                "status": "queued",
-                "progress": 0,
-                "output_url": None,
-                "error": None,
-            })
-        if celery_status == "FAILURE":
-            return JSONResponse({
-                "status": "error",
-                "progress": 0,
-                "output_url": None,
-                "error": str(result.result),
-            })
-        return JSONResponse({
-            "status": celery_status.lower(),
+    job_id = await r.get(f"task:{task_id}")
+    status = progress = output_url = error = None
+    if job_id:
+        status, progress, output_url, error = await r.hmget(
+            f"job:{job_id.decode()}", "status", "progress", "output_url", "error"
+        )
+
+    if status is None:
+        # process_meme stores no result (ignore_result=True), so the Celery
+        # result backend could only ever answer PENDING; skip the blocking
+        # lookup and report the task as queued
+        return ORJSONResponse({
+            "status": "queued",
             "progress": 0,
             "output_url": None,
             "error": None,
         })
 
-    return JSONResponse({
-        "status": job_state.get("status", "unknown"),
-        "progress": job_state.get("progress", 0),
-        "output_url": job_state.get("output_url"),
-        "error": job_state.get("error"),
+    return ORJSONResponse({
+        "status": status.decode() or "unknown",
+        "progress": int(progress) if progress else 0,
+        "output_url": output_url.decode() if output_url else None,
+        "error": error.decode() if error else None,
     })
 
 
+@app.post("/cancel/{task_id}")
+async def cancel(task_id: str):
+    """
+    Cancel a queued or running job.
+
+    Sets task:{task_id}:cancel, which the worker checks at every stage
+    boundary and while Wav2Lip runs. A job still waiting in the queue is
+    marked cancelled straight away, and the worker skips it on pickup.
+    If the job has since been regenerated under a newer task, only the old
+    task is stopped and the job state is left to the new one.
+    """
+    r = _get_redis()
+    job_id = await r.get(f"task:{task_id}")
+    if not job_id:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
+    job_id = job_id.decode()
+
+    status, owner = await r.hmget(f"job:{job_id}", "status", "task_id")
+    owns_job = owner is not None and owner.decode() == task_id
+    if owns_job and status in (b"done", b"error", b"cancelled"):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is already {status.decode()}.")
+
+    pipe = r.pipeline(transaction=False)
+    pipe.set(f"task:{task_id}:cancel", 1, ex=JOB_TTL_SECONDS)
+    if owns_job and status == b"queued":
+        pipe.hset(f"job:{job_id}", mapping={"status": "cancelled", "progress": 0})
+        pipe.expire(f"job:{job_id}", JOB_TTL_SECONDS)
+    await pipe.execute()
+
+    logger.info("Cancel requested for task %s (job %s)", task_id, job_id)
+    return ORJSONResponse({"task_id": task_id, "job_id": job_id, "status": "cancelling"})
+
+
 @app.get("/output/{filename}")
-async def serve_output(filename: str):
+async def serve_output(request: Request, filename: str):
     """Serve a completed output GIF."""
     # Prevent path traversal
     safe_filename = Path(filename).name
     file_path = os.path.join(OUTPUT_DIR, safe_filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Output file not found.")
-    return FileResponse(file_path, media_type="image/gif")
+    return _cached_file_response(request, file_path, media_type="image/gif")
 
 
 @app.get("/health")
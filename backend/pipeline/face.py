@@ -0,0 +1,175 @@
+"""Face detection shared by the preprocess and lip-sync stages (MTCNN)."""
+
+import functools
+import logging
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+FACE_SCAN_FRAMES = 30  # candidate frames batched through MTCNN
+FACE_SCAN_STRIDE = 5   # sample at most every Nth frame
+FACE_FIRST_BATCH = 1   # frames tried before the rest; most memes show a face at once
+DETECT_WIDTH = 320     # frames are downscaled to this width before detection
+MTCNN_MIN_FACE = 20    # smallest face accepted, in original-frame pixels
+PNET_WINDOW = 12       # MTCNN's PNet cannot see faces smaller than this
+
+
+def downscale_for_detection(frame, width: int = DETECT_WIDTH) -> tuple:
+    """
+    Shrink a frame to at most `width` pixels wide for face detection.
+
+    Returns (small_frame, scale); divide detected coordinates by scale to map
+    them back onto the original frame. Frames already narrow enough are
+    returned unchanged with scale 1.0.
+    """
+    w_frame = frame.shape[1]
+    if w_frame <= width:
+        return frame, 1.0
+    scale = width / w_frame
+    small = cv2.resize(frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+def scan_stride(frame_count: int) -> int:
+    """
+    Return the sampling stride for a clip of frame_count frames.
+
+    Short clips are sampled more densely (down to every frame) so that
+    FACE_SCAN_FRAMES candidates are still checked where the clip allows it.
+    """
+    return max(1, min(FACE_SCAN_STRIDE, frame_count // FACE_SCAN_FRAMES))
+
+
+def detection_width(w_frame: int) -> int:
+    """
+    Return the width frames w_frame wide are downscaled to for MTCNN.
+
+    This is DETECT_WIDTH unless that would shrink an MTCNN_MIN_FACE face
+    below PNET_WINDOW, in which case the frame is downscaled only that far.
+    """
+    return max(DETECT_WIDTH, -(-w_frame * PNET_WINDOW // MTCNN_MIN_FACE))
+
+
+class DetectionFrames:
+    """
+    Frames collected for face detection, downscaled as they are added.
+
+    Only the detection_width() copies are kept, so sampling a 1080p clip
+    holds about a third of FACE_SCAN_FRAMES full-resolution frames. All
+    frames come from one source and share `scale` and the original `shape`.
+    """
+
+    def __init__(self) -> None:
+        self.frames: list = []
+        self.scale = 1.0
+        self.shape: tuple[int, int] = (0, 0)
+
+    def add(self, frame) -> None:
+        """Downscale a full-resolution BGR frame and keep the small copy."""
+        small, self.scale = downscale_for_detection(frame, detection_width(frame.shape[1]))
+        self.shape = frame.shape[:2]
+        self.frames.append(small)
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+
+@functools.lru_cache(maxsize=1)
+def get_mtcnn():
+    """
+    Return the process-wide MTCNN detector, building it on first use.
+
+    The fully-connected layers of RNet and ONet are dynamically quantised to
+    int8; dynamic quantisation has no conv kernels, so PNet stays fp32. Only
+    the box and its confidence are used, where the accuracy loss is negligible.
+
+    Raises ImportError if facenet-pytorch is not installed.
+    """
+    import torch
+    from facenet_pytorch import MTCNN
+    from torch.ao.quantization import quantize_dynamic
+
+    mtcnn = MTCNN(keep_all=False, device="cpu", post_process=False)
+    mtcnn.rnet = quantize_dynamic(mtcnn.rnet, {torch.nn.Linear}, dtype=torch.qint8)
+    mtcnn.onet = quantize_dynamic(mtcnn.onet, {torch.nn.Linear}, dtype=torch.qint8)
+    return mtcnn
+
+
+def sample_frames(
+    video_path: str,
+    max_frames: int = FACE_SCAN_FRAMES,
+    stride: int | None = None,
+) -> DetectionFrames:
+    """
+    Return up to max_frames downscaled frames, taking every stride-th frame.
+
+    stride defaults to scan_stride() of the container's frame count.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Cannot open video for face detection: {video_path}")
+    if stride is None:
+        stride = scan_stride(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    # grab() skips frames without the BGR conversion of read()
+    samples = DetectionFrames()
+    while len(samples) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        samples.add(frame)
+        for _ in range(stride - 1):
+            if not cap.grab():
+                break
+
+    cap.release()
+    return samples
+
+
+def detect_face_box_in_frames(samples: DetectionFrames) -> tuple[int, int, int, int] | None:
+    """
+    Detect the first confident face across sampled frames.
+
+    The first FACE_FIRST_BATCH frames are tried on their own and the rest
+    only if they hold no face, each group in one batched MTCNN pass.
+
+    Returns (y1, y2, x1, x2), padded for chin/forehead, suitable for the
+    wav2lip --box argument, or None if no face was found.
+
+    Raises ImportError if facenet-pytorch is not installed.
+    """
+    mtcnn = get_mtcnn()
+    from PIL import Image
+
+    # MTCNN_MIN_FACE in original pixels, measured on the downscaled frames
+    mtcnn.min_face_size = max(PNET_WINDOW, round(MTCNN_MIN_FACE * samples.scale))
+
+    h_frame, w_frame = samples.shape
+    imgs = [Image.fromarray(cv2.cvtColor(f, cv2.COLOR_BGR2RGB)) for f in samples.frames]
+
+    for batch in (imgs[:FACE_FIRST_BATCH], imgs[FACE_FIRST_BATCH:]):
+        if not batch:
+            continue
+        boxes_list, probs_list = mtcnn.detect(batch)
+
+        for boxes, probs in zip(boxes_list, probs_list):
+            if boxes is None or len(boxes) == 0 or probs[0] <= 0.9:
+                continue
+            fx1, fy1, fx2, fy2 = [int(v / samples.scale) for v in boxes[0]]
+            bh = fy2 - fy1
+            # Add padding for chin/forehead so Wav2Lip sees the full face
+            pad_v = int(bh * 0.25)
+            pad_h = int(bh * 0.1)
+            y1 = max(0, fy1 - pad_v)
+            y2 = min(h_frame, fy2 + pad_v)
+            x1 = max(0, fx1 - pad_h)
+            x2 = min(w_frame, fx2 + pad_h)
+            return (y1, y2, x1, x2)
+
+    return None
+
+
+def detect_face_box(video_path: str) -> tuple[int, int, int, int] | None:
+    """Sample frames from video_path and run detect_face_box_in_frames on them."""
+    return detect_face_box_in_frames(sample_frames(video_path))
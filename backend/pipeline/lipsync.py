@@ -4,70 +4,98 @@ import logging
 import os
 import subprocess
 import sys
-
-import cv2
+from collections.abc import Callable
 
 from backend.config import MODEL_PATH, WAV2LIP_DIR
 
 logger = logging.getLogger(__name__)
 
+POLL_SECONDS = 1.0             # how often a running Wav2Lip checks `poll`
+TERMINATE_GRACE_SECONDS = 5.0  # SIGTERM → SIGKILL delay when stopping it
 
-def _run(cmd: list[str], description: str = "", log_file: str | None = None) -> subprocess.CompletedProcess:
-    """Run a subprocess and optionally write stdout/stderr to a log file."""
-    logger.debug("Running: %s", " ".join(cmd))
-    result = subprocess.run(cmd, capture_output=True, text=True)
+# No banner or interactive stdin handling, and only errors on stderr. The
+# trim input can be a .mov/.webm/.avi upload copied as-is by preprocess, so
+# probing is left at ffmpeg's defaults.
+FFMPEG_QUIET_ARGS = ["-hide_banner", "-loglevel", "error", "-nostdin"]
+
+
+def _communicate(
+    proc: subprocess.Popen,
+    poll: Callable[[], None] | None = None,
+) -> bytes:
+    """
+    Wait for proc and return its stderr, calling poll() every POLL_SECONDS.
 
+    If poll raises, proc is terminated (killed if it ignores SIGTERM for
+    TERMINATE_GRACE_SECONDS) and the exception propagates.
+    """
+    while True:
+        try:
+            _, stderr = proc.communicate(timeout=POLL_SECONDS if poll else None)
+            return stderr
+        except subprocess.TimeoutExpired:
+            pass  # communicate() can be resumed without losing output
+        try:
+            poll()
+        except BaseException:
+            logger.info("Stopping %s (pid %d)", proc.args[0], proc.pid)
+            proc.terminate()
+            try:
+                proc.wait(timeout=TERMINATE_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            raise
+
+
+def _run(
+    cmd: list[str],
+    description: str = "",
+    log_file: str | None = None,
+    poll: Callable[[], None] | None = None,
+) -> subprocess.CompletedProcess:
+    """
+    Run a subprocess and optionally write stdout/stderr to a log file.
+
+    stdout is written straight into log_file (or discarded without one)
+    rather than buffered in memory; stderr is kept as bytes for the log and
+    only decoded when building the error message. poll, if given, is called
+    periodically while the command runs; see _communicate.
+    """
+    logger.debug("Running: %s", " ".join(cmd))
     if log_file:
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        with open(log_file, "w") as f:
-            f.write("=== STDOUT ===\n")
-            f.write(result.stdout or "")
-            f.write("\n=== STDERR ===\n")
-            f.write(result.stderr or "")
+        with open(log_file, "wb") as f:
+            f.write(b"=== STDOUT ===\n")
+            f.flush()  # the child appends to the same file descriptor
+            proc = subprocess.Popen(cmd, stdout=f, stderr=subprocess.PIPE)
+            stderr = _communicate(proc, poll)
+            f.write(b"\n=== STDERR ===\n")
+            f.write(stderr)
+    else:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = _communicate(proc, poll)
+    result = subprocess.CompletedProcess(cmd, proc.returncode, None, stderr)
 
     if result.returncode != 0:
+        see_log = f"\n(full output in {log_file})" if log_file else ""
         raise RuntimeError(
             f"{description} failed (exit {result.returncode}):\n"
-            f"stdout: {result.stdout}\nstderr: {result.stderr}"
+            f"stderr: {result.stderr.decode('utf-8', 'replace')}{see_log}"
         )
     return result
 
 
-def _get_audio_duration(wav_path: str) -> float:
-    """Return audio duration in seconds."""
-    cmd = [
-        "ffprobe", "-v", "quiet",
-        "-show_entries", "format=duration",
-        "-of", "csv=p=0",
-        wav_path,
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0 or not result.stdout.strip():
-        return 0.0
-    return float(result.stdout.strip())
-
-
-def _get_video_duration(video_path: str) -> float:
-    """Return video duration in seconds."""
-    cmd = [
-        "ffprobe", "-v", "quiet",
-        "-show_entries", "format=duration",
-        "-of", "csv=p=0",
-        video_path,
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0 or not result.stdout.strip():
-        return 0.0
-    return float(result.stdout.strip())
-
-
 def _trim_video_to_duration(video_path: str, duration: float, output_path: str) -> None:
     """Trim a video to at most `duration` seconds."""
+    # -t as an input option stops demuxing at `duration`; stream copy avoids a
+    # re-encode and make_zero rebases timestamps so the clip starts at 0
     cmd = [
         "ffmpeg", "-y",
-        "-i", video_path,
+        *FFMPEG_QUIET_ARGS,
         "-t", str(duration),
+        "-i", video_path,
         "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
         output_path,
     ]
     _run(cmd, "Video trim")
@@ -82,65 +110,15 @@ def _sfd_ready() -> bool:
     return os.path.isfile(SFD_MODEL_PATH) and os.path.getsize(SFD_MODEL_PATH) >= SFD_MIN_BYTES
 
 
-def _detect_face_box(video_path: str) -> tuple[int, int, int, int] | None:
-    """
-    Detect the first face in the video using MTCNN (facenet-pytorch).
-
-    Returns (y1, y2, x1, x2) for wav2lip --box argument, or None if SFD is
-    available (inference.py will then use SFD natively, which is more accurate).
-    """
-    if _sfd_ready():
-        logger.info("SFD model ready — letting inference.py handle face detection natively")
-        return None
-
-    try:
-        from facenet_pytorch import MTCNN
-        from PIL import Image
-    except ImportError:
-        logger.warning("facenet-pytorch not installed; falling back to SFD detector")
-        return None
-
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        return None
-
-    mtcnn = MTCNN(keep_all=False, device="cpu", post_process=False)
-    found = None
-
-    for _ in range(30):  # check up to 30 frames
-        ret, frame = cap.read()
-        if not ret:
-            break
-        h_frame, w_frame = frame.shape[:2]
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(rgb)
-        boxes, probs = mtcnn.detect(img)
-        if boxes is not None and len(boxes) > 0 and probs[0] > 0.9:
-            fx1, fy1, fx2, fy2 = [int(v) for v in boxes[0]]
-            bh = fy2 - fy1
-            # Add padding for chin/forehead so Wav2Lip sees the full face
-            pad_v = int(bh * 0.25)
-            pad_h = int(bh * 0.1)
-            y1 = max(0, fy1 - pad_v)
-            y2 = min(h_frame, fy2 + pad_v)
-            x1 = max(0, fx1 - pad_h)
-            x2 = min(w_frame, fx2 + pad_h)
-            found = (y1, y2, x1, x2)
-            break
-
-    cap.release()
-    if found:
-        logger.info("Face detected via MTCNN: box=%s (skipping SFD download)", found)
-    else:
-        logger.warning("No face detected via MTCNN; inference.py will use SFD detector")
-    return found
-
-
 def run_lipsync(
     video_path: str,
     audio_path: str,
     output_path: str,
     job_dir: str,
+    audio_duration: float,
+    video_duration: float,
+    face_box: tuple[int, int, int, int] | None = None,
+    poll: Callable[[], None] | None = None,
 ) -> str:
     """
     Run Wav2Lip inference to generate a lip-synced video.
@@ -155,6 +133,17 @@ def run_lipsync(
         Destination path for the Wav2Lip output MP4.
     job_dir : str
         Job working directory (used for log file and temp files).
+    audio_duration : float
+        Duration of audio_path in seconds, as returned by the TTS stage.
+    video_duration : float
+        Duration of video_path in seconds, as returned by the preprocess stage.
+    face_box : tuple or None
+        (y1, y2, x1, x2) MTCNN box from the preprocess stage, passed to
+        inference.py as --box. None lets inference.py run SFD itself.
+    poll : callable, optional
+        Called about once a second while inference runs. If it raises (for
+        example because the job was cancelled), Wav2Lip is terminated and
+        the exception propagates to the caller.
 
     Returns
     -------
@@ -163,9 +152,6 @@ def run_lipsync(
     """
     log_file = os.path.join(job_dir, "lipsync.log")
 
-    audio_duration = _get_audio_duration(audio_path)
-    video_duration = _get_video_duration(video_path)
-
     logger.info(
         "Audio duration: %.2f s | Video duration: %.2f s",
         audio_duration,
@@ -183,9 +169,16 @@ def run_lipsync(
 
     effective_audio_path = audio_path
 
-    # Detect face bounding box with OpenCV so we can pass --box and skip
-    # the SFD face-detector download inside inference.py
-    face_box = _detect_face_box(video_path)
+    # Reuse the preprocess face box so we can pass --box and skip the SFD
+    # face-detector download inside inference.py. If SFD is already present,
+    # let inference.py use it natively, which is more accurate.
+    if _sfd_ready():
+        logger.info("SFD model ready — letting inference.py handle face detection natively")
+        face_box = None
+    elif face_box is not None:
+        logger.info("Using preprocess face box=%s (skipping SFD download)", face_box)
+    else:
+        logger.warning("No MTCNN face box available; inference.py will use SFD detector")
 
     # Verify Wav2Lip repo and model exist
     inference_script = os.path.join(WAV2LIP_DIR, "inference.py")
@@ -200,8 +193,6 @@ def run_lipsync(
             "Download wav2lip_gan.pth and place it in the models/ directory."
         )
 
-    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
-
     cmd = [
         sys.executable, inference_script,
         "--checkpoint_path", MODEL_PATH,
@@ -217,7 +208,7 @@ def run_lipsync(
         cmd += ["--box", str(y1), str(y2), str(x1), str(x2)]
 
     logger.info("Running Wav2Lip inference")
-    _run(cmd, "Wav2Lip inference", log_file=log_file)
+    _run(cmd, "Wav2Lip inference", log_file=log_file, poll=poll)
 
     if not os.path.exists(output_path):
         raise RuntimeError(
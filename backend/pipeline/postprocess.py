@@ -1,33 +1,78 @@
 """Stage 4: Convert lip-synced MP4 back to an optimised GIF."""
 
 import logging
-import os
 import shutil
+import signal
 import subprocess
+import tempfile
 
 logger = logging.getLogger(__name__)
 
+# The input here is always Wav2Lip's output, an H.264 MP4 whose codec
+# parameters sit in the container header, so stream probing can be skipped
+FFMPEG_FAST_ARGS = [
+    "-hide_banner", "-loglevel", "error", "-nostdin",
+    "-analyzeduration", "0", "-probesize", "32k",
+]
+
 
 def _run(cmd: list[str], description: str = "") -> subprocess.CompletedProcess:
-    """Run a subprocess and raise on non-zero exit."""
+    """Run a subprocess and raise on non-zero exit; stderr is decoded only on failure."""
     logger.debug("Running: %s", " ".join(cmd))
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
     if result.returncode != 0:
         raise RuntimeError(
             f"{description} failed (exit {result.returncode}):\n"
-            f"stdout: {result.stdout}\nstderr: {result.stderr}"
+            f"stderr: {result.stderr.decode('utf-8', 'replace')}"
         )
     return result
 
 
+def _run_piped(
+    producer: list[str],
+    consumer: list[str],
+    description: str = "",
+) -> None:
+    """Run `producer | consumer`, streaming stdout into stdin; raise if either fails."""
+    logger.debug("Running: %s | %s", " ".join(producer), " ".join(consumer))
+    # Producer stderr goes to a temp file so a chatty ffmpeg can never fill the
+    # pipe buffer and stall while the consumer is still reading
+    with tempfile.TemporaryFile() as producer_err:
+        prod = subprocess.Popen(producer, stdout=subprocess.PIPE, stderr=producer_err)
+        cons = subprocess.Popen(
+            consumer, stdin=prod.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        prod.stdout.close()  # let the producer see SIGPIPE if the consumer exits
+        _, cons_err = cons.communicate()
+        prod_outlived_cons = prod.poll() is None
+        prod.wait()
+        producer_err.seek(0)
+        prod_err = producer_err.read()
+
+    # Report the failure that came first. A producer killed by SIGPIPE (shell
+    # wrappers report it as 128 + SIGPIPE), or still writing when the consumer
+    # died, only failed because the consumer's end of the pipe went away.
+    checks = [(prod, producer[0], prod_err), (cons, consumer[0], cons_err)]
+    if cons.returncode != 0 and (
+        prod_outlived_cons or prod.returncode in (-signal.SIGPIPE, 128 + signal.SIGPIPE)
+    ):
+        checks.reverse()
+    for proc, name, stderr in checks:
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f"{description} failed ({name} exit {proc.returncode}):\n"
+                f"stderr: {stderr.decode(errors='replace')}"
+            )
+
+
 def convert_to_gif(
     mp4_path: str,
     output_gif_path: str,
     original_fps: float,
 ) -> str:
     """
-    Convert a lip-synced MP4 to an optimised GIF using a two-pass FFmpeg
-    palette approach followed by Gifsicle compression.
+    Convert a lip-synced MP4 to an optimised GIF using a single-pass FFmpeg
+    palette graph followed by Gifsicle compression.
 
     Parameters
     ----------
@@ -43,68 +88,33 @@ def convert_to_gif(
     str
         Path to the optimised GIF (same as output_gif_path).
     """
-    output_dir = os.path.dirname(output_gif_path) or "."
-    os.makedirs(output_dir, exist_ok=True)
-
     fps = min(original_fps, 30.0)  # cap at 30 fps for reasonable GIF size
 
-    palette_path = os.path.join(output_dir, "_palette.png")
-    raw_gif_path = os.path.join(output_dir, "_raw.gif")
-
-    # ── Pass 1: Generate a palette optimised for this video ──────────────────
-    logger.info("GIF pass 1: generating palette (fps=%.2f)", fps)
-    _run(
-        [
-            "ffmpeg", "-y",
-            "-i", mp4_path,
-            "-vf", (
-                f"fps={fps},"
-                "scale=480:-1:flags=lanczos,"
-                "palettegen=stats_mode=diff"
-            ),
-            palette_path,
-        ],
-        "FFmpeg palette generation",
-    )
+    # Single pass: split one decode into palettegen and paletteuse
+    ffmpeg_cmd = [
+        "ffmpeg", "-y",
+        *FFMPEG_FAST_ARGS,
+        "-i", mp4_path,
+        "-filter_complex", (
+            f"fps={fps},"
+            "scale=480:-1:flags=lanczos,"
+            "split[a][b];"
+            "[a]palettegen=stats_mode=diff[p];"
+            "[b][p]paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle"
+        ),
+    ]
 
-    # ── Pass 2: Render GIF using that palette ────────────────────────────────
-    logger.info("GIF pass 2: rendering GIF with palette")
-    _run(
-        [
-            "ffmpeg", "-y",
-            "-i", mp4_path,
-            "-i", palette_path,
-            "-lavfi", (
-                f"fps={fps},"
-                "scale=480:-1:flags=lanczos [x]; [x][1:v] "
-                "paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle"
-            ),
-            raw_gif_path,
-        ],
-        "FFmpeg GIF rendering",
-    )
-
-    # ── Gifsicle optimisation ────────────────────────────────────────────────
     if shutil.which("gifsicle"):
-        logger.info("Running Gifsicle optimisation")
-        _run(
-            [
-                "gifsicle",
-                "-O3",
-                "--lossy=80",
-                raw_gif_path,
-                "-o", output_gif_path,
-            ],
-            "Gifsicle optimisation",
+        # Stream the GIF from ffmpeg straight into Gifsicle — no intermediate file
+        logger.info("Rendering GIF (fps=%.2f) piped into Gifsicle optimisation", fps)
+        _run_piped(
+            ffmpeg_cmd + ["-f", "gif", "pipe:1"],
+            ["gifsicle", "-O3", "--lossy=80", "-", "-o", output_gif_path],
+            "FFmpeg GIF rendering + Gifsicle optimisation",
         )
-        os.unlink(raw_gif_path)
     else:
         logger.warning("gifsicle not found — skipping optimisation step")
-        os.rename(raw_gif_path, output_gif_path)
-
-    # Cleanup palette
-    if os.path.exists(palette_path):
-        os.unlink(palette_path)
+        _run(ffmpeg_cmd + [output_gif_path], "FFmpeg GIF rendering")
 
     logger.info("GIF written to: %s", output_gif_path)
     return output_gif_path
@@ -1,64 +1,114 @@
 """Stage 1: Preprocess GIF or MP4 input into a standardised MP4 for Wav2Lip."""
 
-import json
 import logging
+import math
 import os
 import shutil
 import subprocess
+from fractions import Fraction
 from pathlib import Path
 
+import av
 import cv2
 
+from backend.pipeline.face import (
+    DETECT_WIDTH,
+    FACE_SCAN_FRAMES,
+    DetectionFrames,
+    detect_face_box_in_frames,
+    downscale_for_detection,
+    sample_frames,
+    scan_stride,
+)
+
 logger = logging.getLogger(__name__)
 
+# Haar cascade fallback for when facenet-pytorch is unavailable; parsed once
+_FACE_CASCADE = cv2.CascadeClassifier(
+    cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+)
+HAAR_MIN_FACE = 30  # smallest face accepted, in original-frame pixels
+
+# Wav2Lip re-encodes its output, so the intermediate MP4 favours encode speed
+# over bitrate; threads 0 lets x264 use every core
+X264_FAST_OPTIONS = {"preset": "ultrafast", "tune": "zerolatency"}
+X264_FAST_ARGS = ["-preset", "ultrafast", "-tune", "zerolatency", "-threads", "0"]
+
+# No banner or interactive stdin handling, and only errors on stderr. Inputs
+# here are arbitrary user uploads, so probing is left at ffmpeg's defaults.
+FFMPEG_QUIET_ARGS = ["-hide_banner", "-loglevel", "error", "-nostdin"]
 
-def _run(cmd: list[str], description: str = "") -> subprocess.CompletedProcess:
-    """Run a subprocess command and raise on non-zero exit."""
+
+def _run(
+    cmd: list[str],
+    description: str = "",
+    capture_stdout: bool = False,
+) -> subprocess.CompletedProcess:
+    """
+    Run a subprocess command and raise on non-zero exit.
+
+    Output is kept as bytes: stdout is discarded unless capture_stdout is
+    set, and stderr is only decoded to build the error message.
+    """
     logger.debug("Running: %s", " ".join(cmd))
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    result = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
     if result.returncode != 0:
         raise RuntimeError(
             f"{description} failed (exit {result.returncode}):\n"
-            f"stdout: {result.stdout}\nstderr: {result.stderr}"
+            f"stderr: {result.stderr.decode('utf-8', 'replace')}"
         )
     return result
 
 
-def _extract_gif_fps(input_path: str) -> float:
-    """Return average FPS derived from GIF frame delays via ffprobe."""
+def _probe_video_stream(path: str, description: str = "ffprobe") -> dict[str, str]:
+    """Return the frame-rate, frame-count and duration fields of the first video stream."""
     cmd = [
         "ffprobe",
-        "-v", "quiet",
-        "-print_format", "json",
-        "-show_streams",
-        input_path,
+        "-hide_banner",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=r_frame_rate,avg_frame_rate,nb_frames,duration",
+        "-of", "default=nw=1",
+        path,
     ]
-    result = _run(cmd, "ffprobe")
-    data = json.loads(result.stdout)
-
-    # Try to pull r_frame_rate from the first video stream
-    for stream in data.get("streams", []):
-        if stream.get("codec_type") == "video":
-            r_frame_rate = stream.get("r_frame_rate", "")
-            if r_frame_rate and "/" in r_frame_rate:
-                num, den = r_frame_rate.split("/")
-                num, den = int(num), int(den)
-                if den > 0 and num > 0:
-                    fps = num / den
-                    # GIF r_frame_rate is often reported as 100/1; clamp to sane range
-                    if fps > 50:
-                        fps = 10.0
-                    return fps
-
-    # Fallback: count frames and use avg_frame_rate
-    for stream in data.get("streams", []):
-        if stream.get("codec_type") == "video":
-            avg = stream.get("avg_frame_rate", "10/1")
-            if avg and "/" in avg:
-                num, den = avg.split("/")
-                num, den = int(num), int(den)
-                if den > 0 and num > 0:
-                    return min(num / den, 30.0)
+    result = _run(cmd, description, capture_stdout=True)
+
+    # One key=value line per field; ffprobe reports unknown values as N/A
+    fields = {}
+    for line in result.stdout.decode().splitlines():
+        key, sep, value = line.partition("=")
+        if sep and value != "N/A":
+            fields[key.strip()] = value.strip()
+    return fields
+
+
+def _extract_gif_fps(input_path: str) -> float:
+    """Return average FPS derived from GIF frame delays via ffprobe."""
+    stream = _probe_video_stream(input_path)
+
+    # Try r_frame_rate from the first video stream
+    r_frame_rate = stream.get("r_frame_rate", "")
+    if r_frame_rate and "/" in r_frame_rate:
+        num, den = r_frame_rate.split("/")
+        num, den = int(num), int(den)
+        if den > 0 and num > 0:
+            fps = num / den
+            # GIF r_frame_rate is often reported as 100/1; clamp to sane range
+            if fps > 50:
+                fps = 10.0
+            return fps
+
+    # Fallback: use avg_frame_rate
+    avg = stream.get("avg_frame_rate", "10/1")
+    if avg and "/" in avg:
+        num, den = avg.split("/")
+        num, den = int(num), int(den)
+        if den > 0 and num > 0:
+            return min(num / den, 30.0)
 
     return 10.0  # safe default for GIFs
 
@@ -71,82 +121,138 @@ def _image_to_mp4(input_path: str, output_path: str, fps: float = 25, duration:
     """
     cmd = [
         "ffmpeg", "-y",
+        *FFMPEG_QUIET_ARGS,
         "-loop", "1",
         "-i", input_path,
         "-t", str(duration),
         "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",  # ensure even dimensions for x264
         "-c:v", "libx264",
+        *X264_FAST_ARGS,
         "-pix_fmt", "yuv420p",
         output_path,
     ]
     _run(cmd, "Image→MP4 conversion")
 
 
-def _gif_to_mp4(input_path: str, output_path: str, fps: float) -> None:
-    """Convert a GIF to MP4 using FFmpeg."""
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", input_path,
-        "-vf", f"fps={fps}",
-        "-c:v", "libx264",
-        "-pix_fmt", "yuv420p",
-        output_path,
-    ]
-    _run(cmd, "GIF→MP4 conversion")
+def _gif_to_mp4(input_path: str, output_path: str, fps: float) -> DetectionFrames:
+    """
+    Convert a GIF to a constant-frame-rate MP4 in-process with PyAV.
+
+    Output frame n shows whichever GIF frame is on screen at n / fps, like
+    ffmpeg's fps filter. Every scan_stride()-th output frame (up to
+    FACE_SCAN_FRAMES) is also returned, downscaled for detection, so face
+    detection can reuse this decode instead of reading the MP4 back.
+    """
+    rate = Fraction(fps).limit_denominator(1001)
+    time_base = 1 / rate
+    face_frames = DetectionFrames()
+
+    with av.open(input_path) as src, av.open(output_path, "w") as dst:
+        gif_duration = Fraction(src.duration or 0, av.time_base)
+        stride = scan_stride(int(gif_duration * rate))
+        in_stream = src.streams.video[0]
+        out_stream = dst.add_stream("libx264", rate=rate)
+        # x264 with yuv420p needs even dimensions
+        width = in_stream.codec_context.width // 2 * 2
+        height = in_stream.codec_context.height // 2 * 2
+        out_stream.width = width
+        out_stream.height = height
+        out_stream.pix_fmt = "yuv420p"
+        out_stream.codec_context.time_base = time_base
+        out_stream.codec_context.options = dict(X264_FAST_OPTIONS)
+        out_stream.codec_context.thread_count = 0  # one thread per core
+
+        def to_index(seconds: Fraction) -> int:
+            # Nearest output frame, halves rounded up, as the fps filter does;
+            # exact so that e.g. 0.1 s at 10 fps lands on frame 1, not 0 or 2
+            return math.floor(seconds * rate + Fraction(1, 2))
+
+        out_index = 0
+
+        def emit_until(frame, until: int) -> None:
+            nonlocal out_index
+            while out_index < until:
+                if out_index % stride == 0 and len(face_frames) < FACE_SCAN_FRAMES:
+                    face_frames.add(frame.to_ndarray(format="bgr24"))
+                frame.pts = out_index
+                frame.time_base = time_base
+                dst.mux(out_stream.encode(frame))
+                out_index += 1
+
+        # Each GIF frame is held until the next one starts; a frame that
+        # rounds onto the same output index as its successor is dropped
+        prev = None
+        for frame in src.decode(in_stream):
+            if prev is not None:
+                emit_until(prev, to_index(Fraction(frame.pts) * in_stream.time_base))
+            prev = frame.reformat(width=width, height=height, format="yuv420p")
+
+        if prev is not None:
+            # Hold the last frame until the end of the GIF (at least one frame)
+            emit_until(prev, max(to_index(gif_duration), out_index + 1))
+
+        dst.mux(out_stream.encode())  # flush the encoder
+
+    return face_frames
 
 
 def _get_video_info(mp4_path: str) -> dict:
     """Return fps, frame_count, and duration_seconds for an MP4."""
-    cmd = [
-        "ffprobe",
-        "-v", "quiet",
-        "-print_format", "json",
-        "-show_streams",
-        mp4_path,
-    ]
-    result = _run(cmd, "ffprobe (mp4 info)")
-    data = json.loads(result.stdout)
+    stream = _probe_video_stream(mp4_path, "ffprobe (mp4 info)")
+    if not stream:
+        raise ValueError("No video stream found in file")
 
-    for stream in data.get("streams", []):
-        if stream.get("codec_type") == "video":
-            r_frame_rate = stream.get("r_frame_rate", "25/1")
-            num, den = r_frame_rate.split("/")
-            fps = int(num) / int(den)
+    r_frame_rate = stream.get("r_frame_rate", "25/1")
+    num, den = r_frame_rate.split("/")
+    fps = int(num) / int(den)
 
-            nb_frames = stream.get("nb_frames")
-            duration = stream.get("duration")
+    nb_frames = stream.get("nb_frames")
+    duration = stream.get("duration")
 
-            if nb_frames:
-                frame_count = int(nb_frames)
-            elif duration:
-                frame_count = int(float(duration) * fps)
-            else:
-                frame_count = 0
+    if nb_frames:
+        frame_count = int(nb_frames)
+    elif duration:
+        frame_count = int(float(duration) * fps)
+    else:
+        frame_count = 0
+
+    duration_seconds = float(duration) if duration else (frame_count / fps if fps else 0)
+    return {
+        "fps": fps,
+        "frame_count": frame_count,
+        "duration_seconds": duration_seconds,
+    }
 
-            duration_seconds = float(duration) if duration else (frame_count / fps if fps else 0)
-            return {
-                "fps": fps,
-                "frame_count": frame_count,
-                "duration_seconds": duration_seconds,
-            }
 
-    raise ValueError("No video stream found in file")
+def _haar_has_face(frame) -> bool:
+    """
+    Return True if the Haar cascade finds a face of at least HAAR_MIN_FACE px.
+
+    The cascade cannot see faces smaller than its training window (24 px),
+    so the frame is downscaled only as far as keeps a HAAR_MIN_FACE face at
+    that size, and minSize is scaled to match.
+    """
+    window = _FACE_CASCADE.getOriginalWindowSize()[0]
+    w_frame = frame.shape[1]
+    width = max(DETECT_WIDTH, -(-w_frame * window // HAAR_MIN_FACE))
+    small, scale = downscale_for_detection(frame, width)
+    min_side = max(window, round(HAAR_MIN_FACE * scale))
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    faces = _FACE_CASCADE.detectMultiScale(
+        gray, scaleFactor=1.1, minNeighbors=4, minSize=(min_side, min_side),
+    )
+    return len(faces) > 0
 
 
 def _has_face(mp4_path: str, max_frames: int = 10) -> bool:
     """Return True if a face is detected in any of the first max_frames frames."""
-    cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-    face_cascade = cv2.CascadeClassifier(cascade_path)
-
     # For static images, use imread directly
     suffix = Path(mp4_path).suffix.lower()
     if suffix in (".jpg", ".jpeg", ".png", ".webp"):
         frame = cv2.imread(mp4_path)
         if frame is None:
             return False
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=4, minSize=(30, 30))
-        return len(faces) > 0
+        return _haar_has_face(frame)
 
     cap = cv2.VideoCapture(mp4_path)
     if not cap.isOpened():
@@ -158,9 +264,7 @@ def _has_face(mp4_path: str, max_frames: int = 10) -> bool:
         ret, frame = cap.read()
         if not ret:
             break
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=4, minSize=(30, 30))
-        if len(faces) > 0:
+        if _haar_has_face(frame):
             found = True
             break
         frame_idx += 1
@@ -182,23 +286,29 @@ def preprocess_video(input_path: str, job_dir: str) -> dict:
 
     Returns
     -------
-    dict with keys: mp4_path, fps, frame_count, duration_seconds, has_face
+    dict with keys: mp4_path, fps, frame_count, duration_seconds, has_face,
+    face_box ((y1, y2, x1, x2) for wav2lip --box, or None without MTCNN)
     """
-    os.makedirs(job_dir, exist_ok=True)
     input_path = str(input_path)
     suffix = Path(input_path).suffix.lower()
 
     mp4_path = os.path.join(job_dir, "input.mp4")
+    face_frames = None  # DetectionFrames, when the conversion already has them
 
     if suffix == ".gif":
         logger.info("Input is GIF — extracting FPS and converting to MP4")
         fps = _extract_gif_fps(input_path)
         logger.info("Detected GIF FPS: %.2f", fps)
-        _gif_to_mp4(input_path, mp4_path, fps)
+        face_frames = _gif_to_mp4(input_path, mp4_path, fps)
     elif suffix in (".jpg", ".jpeg", ".png", ".webp"):
         logger.info("Input is image — creating 30-second looping MP4")
         fps = 25.0
         _image_to_mp4(input_path, mp4_path, fps=fps)
+        # Every frame of the loop is the same image: detect on it once
+        image = cv2.imread(input_path)
+        if image is not None:
+            face_frames = DetectionFrames()
+            face_frames.add(image)
     elif suffix in (".mp4", ".mov", ".webm", ".avi"):
         logger.info("Input is video — copying to job directory")
         shutil.copy2(input_path, mp4_path)
@@ -207,8 +317,17 @@ def preprocess_video(input_path: str, job_dir: str) -> dict:
 
     info = _get_video_info(mp4_path)
 
-    logger.info("Running face detection on first 10 frames")
-    face_found = _has_face(mp4_path)
+    logger.info("Running MTCNN face detection")
+    try:
+        # GIF and image inputs already have their frames; videos decode the MP4
+        if face_frames is None:
+            face_frames = sample_frames(mp4_path, stride=scan_stride(info["frame_count"]))
+        face_box = detect_face_box_in_frames(face_frames)
+        face_found = face_box is not None
+    except ImportError:
+        logger.warning("facenet-pytorch not installed; falling back to Haar cascade")
+        face_box = None
+        face_found = _has_face(mp4_path)
 
     if not face_found:
         raise ValueError(
@@ -222,4 +341,5 @@ def preprocess_video(input_path: str, job_dir: str) -> dict:
         "frame_count": info["frame_count"],
         "duration_seconds": info["duration_seconds"],
         "has_face": True,
+        "face_box": face_box,
     }
@@ -1,31 +1,280 @@
 """Stage 2: Text-to-speech using espeak-ng → 16 kHz mono WAV."""
 
+import fcntl
+import hashlib
 import logging
 import os
+import shutil
+import signal
+import struct
 import subprocess
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+import soxr
+
+from backend.config import TTS_CACHE_DIR, TTS_CACHE_MAX_AGE_DAYS, TTS_CACHE_MAX_MB
 
 logger = logging.getLogger(__name__)
 
+SAMPLE_RATE = 16000  # Wav2Lip expects 16 kHz mono
+READ_CHUNK_BYTES = 1 << 16  # espeak-ng stdout is consumed in 64 KiB reads
+CACHE_PRUNE_INTERVAL = 600  # seconds between cache prunes on a miss, per process
+CACHE_PARTIAL_GRACE = 600   # age after which locks/temp files without an entry go
 
-def _run(cmd: list[str], description: str = "") -> subprocess.CompletedProcess:
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"{description} failed (exit {result.returncode}):\n"
-            f"stdout: {result.stdout}\nstderr: {result.stderr}"
-        )
-    return result
 
+class _PcmScratch:
+    """
+    Read buffer for espeak-ng output, reused across TTS calls.
+
+    Audio is resampled chunk by chunk as it arrives, so one READ_CHUNK_BYTES
+    buffer per worker process is all the PCM that is ever held at once.
+    """
+
+    def __init__(self) -> None:
+        self._buf: bytearray | None = None
+
+    def view(self) -> memoryview:
+        """Return a writable view of the buffer, allocating it on first use."""
+        if self._buf is None:
+            self._buf = bytearray(READ_CHUNK_BYTES)
+        return memoryview(self._buf)
+
+
+_SCRATCH = _PcmScratch()
+# Held for the whole synthesis, since the buffer is shared; only matters when
+# a worker runs tasks on threads
+_SCRATCH_LOCK = threading.Lock()
+
+
+def preallocate_scratch() -> None:
+    """Allocate the PCM read buffer up front (called at worker start-up)."""
+    _SCRATCH.view()
+
+
+def _parse_wav_header(head: bytes) -> tuple[int, int, int] | None:
+    """
+    Parse a 16-bit PCM WAV header into (sample_rate, channels, data_offset).
+
+    Returns None if head does not yet contain the start of the data chunk.
+    espeak-ng --stdout writes a streaming header with placeholder chunk
+    sizes, so the data chunk size is ignored and samples run to EOF.
+    """
+    if len(head) < 12:
+        return None
+    if head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        raise RuntimeError("espeak-ng did not produce a RIFF/WAVE stream.")
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(head):
+        chunk_id = bytes(head[offset : offset + 4])
+        (size,) = struct.unpack_from("<I", head, offset + 4)
+        body = offset + 8
+        if chunk_id == b"data":
+            if fmt is None:
+                raise RuntimeError("WAV data chunk precedes its fmt chunk.")
+            _, channels, rate, _, _, bits = fmt
+            if bits != 16:
+                raise RuntimeError(f"Unsupported WAV sample width: {bits} bits")
+            return rate, channels, body
+        if chunk_id == b"fmt ":
+            if body + 16 > len(head):
+                return None
+            fmt = struct.unpack_from("<HHIIHH", head, body)
+        offset = body + size + (size & 1)
+
+    return None
+
+
+def _resample_stream(stream, output_wav_path: str) -> int:
+    """
+    Resample a 16-bit PCM WAV byte stream to 16 kHz mono as it is read.
+
+    Each chunk is downmixed and pushed through a soxr stream resampler and
+    the result appended to output_wav_path, so resampling overlaps with
+    synthesis instead of waiting for the whole utterance. A stream that is
+    already 16 kHz mono is written through unchanged.
+
+    Returns the number of frames written.
+    """
+    buf = _SCRATCH.view()
+
+    head = bytearray()
+    header = None
+    while header is None:
+        n = stream.readinto(buf)
+        if not n:
+            raise RuntimeError("espeak-ng produced no WAV header.")
+        head += buf[:n]
+        header = _parse_wav_header(head)
+    rate, channels, data_offset = header
+
+    frame_bytes = 2 * channels
+    resampler = None
+    if rate != SAMPLE_RATE:
+        resampler = soxr.ResampleStream(rate, SAMPLE_RATE, 1, dtype="int16", quality="HQ")
+    # 16 kHz mono sources (e.g. mbrola voices) are already in Wav2Lip's
+    # format: their PCM is copied into the output without touching numpy
+    passthrough = resampler is None and channels == 1
+
+    frames = 0
+    with wave.open(output_wav_path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+
+        def emit(pcm, last: bool = False) -> None:
+            nonlocal frames
+            if passthrough:
+                w.writeframes(pcm)
+                frames += len(pcm) // 2
+                return
+            samples = np.frombuffer(pcm, dtype="<i2")
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+            if resampler is not None:
+                samples = resampler.resample_chunk(samples, last=last)
+            w.writeframes(samples.astype("<i2", copy=False).tobytes())
+            frames += len(samples)
 
-def _get_audio_duration(wav_path: str) -> float:
-    cmd = [
-        "ffprobe", "-v", "quiet",
-        "-show_entries", "format=duration",
-        "-of", "csv=p=0",
-        wav_path,
-    ]
-    result = _run(cmd, "ffprobe (audio duration)")
-    return float(result.stdout.strip())
+        # Bytes of a frame split across reads are carried into the next one
+        pending = bytes(head[data_offset:])
+        while True:
+            n = stream.readinto(buf)
+            if not n:
+                break
+            data = pending + buf[:n] if pending else buf[:n]
+            usable = len(data) - len(data) % frame_bytes
+            emit(data[:usable])
+            pending = bytes(data[usable:])
+
+        emit(pending[: len(pending) - len(pending) % frame_bytes], last=True)
+
+    return frames
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hard-link src to dst, copying instead when linking is not possible."""
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _read_cached(cache_wav: str, cache_dur: str, output_wav_path: str) -> float | None:
+    """Link a cached WAV into output_wav_path and return its duration, or None on a miss."""
+    # A concurrent prune can remove the entry at any point, and a .dur from
+    # before the atomic writes may be empty; treat either as a miss
+    try:
+        with open(cache_dur) as f:
+            duration = float(f.read())
+        _link_or_copy(cache_wav, output_wav_path)
+        os.utime(cache_dur)  # mtime of .dur is the entry's last use, for pruning
+    except (FileNotFoundError, ValueError):
+        return None
+    return duration
+
+
+_last_prune = 0.0
+
+
+def prune_tts_cache() -> None:
+    """
+    Bound TTS_CACHE_DIR by age and size.
+
+    Files are grouped by cache key. Complete entries (.wav + .dur) unused
+    for TTS_CACHE_MAX_AGE_DAYS are removed, then the least recently used
+    until the cache fits in TTS_CACHE_MAX_MB. Anything else (a .lock left
+    by a failed synthesis, a crashed mkstemp temp file) is removed once it
+    is CACHE_PARTIAL_GRACE seconds old. Safe to run from several processes.
+    """
+    global _last_prune
+    _last_prune = time.monotonic()
+
+    groups: dict[str, list[os.DirEntry]] = {}
+    with os.scandir(TTS_CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                groups.setdefault(entry.name.split(".", 1)[0], []).append(entry)
+
+    now = time.time()
+    complete = []  # (last_used, size, entries)
+    doomed = []
+    for key, entries in groups.items():
+        try:
+            stats = [e.stat() for e in entries]
+        except FileNotFoundError:
+            continue  # removed under us by another pruner
+        names = {e.name for e in entries}
+        newest = max(st.st_mtime for st in stats)
+        if {f"{key}.wav", f"{key}.dur"} <= names:
+            complete.append((newest, sum(st.st_size for st in stats), entries))
+        elif now - newest > CACHE_PARTIAL_GRACE:
+            doomed.extend(entries)
+
+    complete.sort(key=lambda item: item[0], reverse=True)  # most recent first
+    budget = TTS_CACHE_MAX_MB * 1024 * 1024
+    total = 0
+    for last_used, size, entries in complete:
+        total += size
+        if total > budget or now - last_used > TTS_CACHE_MAX_AGE_DAYS * 86400:
+            doomed.extend(entries)
+
+    for entry in doomed:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+    if doomed:
+        logger.info("Pruned %d file(s) from the TTS cache", len(doomed))
+
+
+def _synthesise(text: str, output_wav_path: str, voice: str | None = None) -> float:
+    """Synthesise text to a 16 kHz mono WAV; return its duration in seconds."""
+    logger.info("Synthesising speech with espeak-ng → 16 kHz mono WAV")
+    cmd = ["espeak-ng", "--stdout"]
+    if voice:
+        cmd += ["-v", voice]
+    cmd.append(text)
+    logger.debug("Running: %s", " ".join(cmd))
+    # stderr goes to a temp file so it can never fill a pipe buffer and stall
+    # espeak-ng while stdout is being drained
+    with _SCRATCH_LOCK, tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        stream_error = None
+        try:
+            frames = _resample_stream(proc.stdout, output_wav_path)
+        except RuntimeError as exc:
+            stream_error = exc
+        finally:
+            proc.stdout.close()  # unblocks espeak-ng with SIGPIPE if we bailed early
+            proc.wait()
+
+        # A failing espeak-ng (e.g. an unknown voice) writes no WAV at all, so
+        # its exit status and stderr explain any stream error and are raised
+        # first. A SIGPIPE exit after a stream error is our own doing (shell
+        # wrappers report it as 128 + SIGPIPE).
+        sigpipe = stream_error is not None and proc.returncode in (
+            -signal.SIGPIPE, 128 + signal.SIGPIPE,
+        )
+        if proc.returncode != 0 and not sigpipe:
+            err.seek(0)
+            raise RuntimeError(
+                f"espeak-ng TTS failed (exit {proc.returncode}):\n"
+                f"stderr: {err.read().decode('utf-8', 'replace')}"
+            ) from stream_error
+        if stream_error is not None:
+            raise stream_error
+
+    if frames == 0:
+        raise RuntimeError("espeak-ng produced an empty audio file.")
+    return frames / SAMPLE_RATE
 
 
 def generate_speech(
@@ -36,33 +285,59 @@ def generate_speech(
     """
     Convert text to a 16 kHz mono WAV using espeak-ng.
 
+    Results are cached in TTS_CACHE_DIR by SHA-256 of (voice, text) and
+    hard-linked into output_wav_path, so retries and repeated texts skip
+    synthesis. Identical requests arriving concurrently are synthesised
+    once.
+
+    voice is passed to espeak-ng as -v (default voice when None). 16 kHz
+    voices such as the mbrola ones skip resampling entirely.
+
     Returns audio duration in seconds.
     """
     if not text or not text.strip():
         raise ValueError("Text for TTS cannot be empty.")
 
-    os.makedirs(os.path.dirname(output_wav_path) or ".", exist_ok=True)
-
-    # espeak-ng writes a WAV directly; default sample rate is 22050 Hz
-    logger.info("Synthesising speech with espeak-ng")
-    raw_wav = output_wav_path + ".raw.wav"
-    _run(["espeak-ng", "-w", raw_wav, text], "espeak-ng TTS")
+    text = " ".join(text.split())
+    key = hashlib.sha256(f"{voice or ''}|{text}".encode()).hexdigest()
+    cache_wav = os.path.join(TTS_CACHE_DIR, f"{key}.wav")
+    cache_dur = os.path.join(TTS_CACHE_DIR, f"{key}.dur")
 
-    if not os.path.exists(raw_wav) or os.path.getsize(raw_wav) == 0:
-        raise RuntimeError("espeak-ng produced an empty audio file.")
+    duration = _read_cached(cache_wav, cache_dur, output_wav_path)
+    if duration is not None:
+        logger.info("TTS cache hit %s (%.2f s)", key[:12], duration)
+        return duration
 
-    # Resample to 16 kHz mono (required by Wav2Lip)
-    logger.info("Resampling to 16 kHz mono WAV")
-    _run([
-        "ffmpeg", "-y",
-        "-i", raw_wav,
-        "-ar", "16000",
-        "-ac", "1",
-        output_wav_path,
-    ], "FFmpeg WAV resample")
+    # Concurrent requests for the same (voice, text), from any worker process,
+    # coalesce on a per-key lock: the first synthesises while the rest wait
+    # and are then served from the cache
+    with open(os.path.join(TTS_CACHE_DIR, f"{key}.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        duration = _read_cached(cache_wav, cache_dur, output_wav_path)
+        if duration is not None:
+            logger.info("TTS cache hit %s after waiting on a concurrent synthesis", key[:12])
+            return duration
 
-    os.unlink(raw_wav)
+        # Synthesise into private temp files and publish each atomically,
+        # the duration first so a visible cache WAV always has its .dur;
+        # readers outside the lock never see a partly written file
+        fd, tmp_wav = tempfile.mkstemp(suffix=".wav", dir=TTS_CACHE_DIR)
+        os.close(fd)
+        fd, tmp_dur = tempfile.mkstemp(suffix=".dur", dir=TTS_CACHE_DIR)
+        os.close(fd)
+        try:
+            duration = _synthesise(text, tmp_wav, voice)
+            with open(tmp_dur, "w") as f:
+                f.write(repr(duration))
+            os.replace(tmp_dur, cache_dur)
+            os.replace(tmp_wav, cache_wav)
+        finally:
+            for tmp in (tmp_wav, tmp_dur):
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
 
-    duration = _get_audio_duration(output_wav_path)
+    _link_or_copy(cache_wav, output_wav_path)
     logger.info("TTS audio duration: %.2f s", duration)
+    if time.monotonic() - _last_prune > CACHE_PRUNE_INTERVAL:
+        prune_tts_cache()
     return duration
@@ -1,46 +1,114 @@
 """Celery async tasks for the meme lip-sync pipeline."""
 
-import json
+import functools
 import logging
 import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
+import redis
 from celery import Celery
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init
 
-from backend.config import OUTPUT_DIR, REDIS_URL, TEMP_DIR
+from backend.config import JOB_TTL_SECONDS, OUTPUT_DIR, REDIS_URL, TEMP_DIR
+from backend.pipeline.face import get_mtcnn
 from backend.pipeline.lipsync import run_lipsync
 from backend.pipeline.postprocess import convert_to_gif
 from backend.pipeline.preprocess import preprocess_video
-from backend.pipeline.tts import generate_speech
+from backend.pipeline.tts import generate_speech, preallocate_scratch, prune_tts_cache
 
 logger = logging.getLogger(__name__)
 
 celery_app = Celery("meme_lipsync", broker=REDIS_URL, backend=REDIS_URL)
 
 celery_app.conf.update(
-    task_serializer="json",
-    result_serializer="json",
-    accept_content=["json"],
+    task_serializer="msgpack",
+    result_serializer="msgpack",
+    accept_content=["msgpack"],
+    redis_socket_keepalive=True,
     timezone="UTC",
     enable_utc=True,
 )
 
+# ── Worker warm-up ────────────────────────────────────────────────────────────
+
+# Version probes run at start-up so each binary is paged into the OS cache
+# before the first job spawns it
+_WARM_BINARIES = [
+    ["ffmpeg", "-version"],
+    ["ffprobe", "-version"],
+    ["espeak-ng", "--version"],
+    ["gifsicle", "--version"],
+]
+
+
+def _page_in_binaries() -> None:
+    """Run every external tool once, in parallel, discarding its output."""
+    procs = []
+    for cmd in _WARM_BINARIES:
+        if shutil.which(cmd[0]) is None:
+            logger.warning("%s not found on PATH", cmd[0])
+            continue
+        procs.append(subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+    for proc in procs:
+        proc.wait()
+
+
+@worker_process_init.connect
+def _warm_worker(**_kwargs) -> None:
+    """
+    Pay every cold-start cost once per worker process, before the first job.
+
+    Module-level imports (redis, av, numpy, soxr, cv2) already happen in the
+    parent before prefork, so this covers what is still lazy: the first
+    Redis connection, the MTCNN/torch/PIL imports, the TTS buffer and the
+    external binaries. The TTS cache is also pruned here.
+    """
+    try:
+        _get_redis().ping()
+    except redis.RedisError as exc:
+        logger.warning("Redis not reachable at worker start-up: %s", exc)
+    preallocate_scratch()
+    prune_tts_cache()
+    try:
+        get_mtcnn()
+        from PIL import Image  # noqa: F401 — first used by face detection
+        logger.info("MTCNN face detector loaded")
+    except ImportError:
+        logger.info("facenet-pytorch not installed; preprocess will use the Haar cascade")
+    _page_in_binaries()
+
+
 # ── Redis helpers ─────────────────────────────────────────────────────────────
 
-def _get_redis():
-    """Return a Redis client."""
-    import redis
-    return redis.from_url(REDIS_URL)
+@functools.lru_cache(maxsize=1)
+def _get_redis() -> redis.Redis:
+    """Return the process-wide Redis client (one shared connection pool)."""
+    return redis.Redis.from_url(REDIS_URL, decode_responses=False, socket_keepalive=True)
 
 
-def _set_job_state(job_id: str, state: dict) -> None:
-    r = _get_redis()
-    r.set(f"job:{job_id}", json.dumps(state))
+def _encode_job_state(state: dict) -> dict:
+    """Flatten a job state dict into Redis hash fields (None → empty string)."""
+    return {k: "" if v is None else v for k, v in state.items()}
 
 
-def _get_job_state(job_id: str) -> dict | None:
-    r = _get_redis()
-    raw = r.get(f"job:{job_id}")
-    return json.loads(raw) if raw else None
+def _set_job_state(
+    job_id: str,
+    state: dict,
+    pipeline: redis.client.Pipeline | None = None,
+) -> None:
+    # Every write refreshes the TTL, so a job expires JOB_TTL_SECONDS after
+    # its last state change; HSET and EXPIRE always share one round-trip
+    key = f"job:{job_id}"
+    pipe = pipeline if pipeline is not None else _get_redis().pipeline(transaction=False)
+    pipe.hset(key, mapping=_encode_job_state(state))
+    pipe.expire(key, JOB_TTL_SECONDS)
+    if pipeline is None:
+        pipe.execute()
 
 
 def _update_state(
@@ -49,78 +117,158 @@ def _update_state(
     progress: int,
     output_url: str | None = None,
     error: str | None = None,
+    pipeline: redis.client.Pipeline | None = None,
 ) -> None:
-    # Merge into existing state so task_id and other fields are preserved
-    existing = _get_job_state(job_id) or {}
-    existing.update({
+    # HSET only touches these fields, so task_id and input_path are preserved.
+    # With a pipeline the write is queued until the caller executes it.
+    _set_job_state(job_id, {
         "status": status,
         "progress": progress,
         "output_url": output_url,
         "error": error,
-    })
-    _set_job_state(job_id, existing)
+    }, pipeline=pipeline)
     logger.info("Job %s → %s (%d%%)", job_id, status, progress)
 
 
+# ── Cancellation ──────────────────────────────────────────────────────────────
+
+class JobCancelled(Exception):
+    """Raised inside process_meme once /cancel has flagged its task."""
+
+
+def _cancel_key(task_id: str) -> str:
+    # Per task, not per job: a regenerate of the same job gets a new task_id,
+    # so cancelling the old task can neither be cleared nor leak into the new one
+    return f"task:{task_id}:cancel"
+
+
+def _check_cancelled(task_id: str) -> None:
+    """
+    Raise JobCancelled if the task's cancel flag is set.
+
+    Wav2Lip polls this every second for minutes, so a Redis error is logged
+    and treated as "not cancelled" rather than failing the job; the next
+    poll or stage boundary checks again.
+    """
+    try:
+        cancelled = _get_redis().exists(_cancel_key(task_id))
+    except redis.RedisError as exc:
+        logger.warning("Could not read cancel flag for task %s: %s", task_id, exc)
+        return
+    if cancelled:
+        raise JobCancelled(task_id)
+
+
+def _flush(pipe: redis.client.Pipeline, task_id: str) -> None:
+    """Execute queued state writes, reading the cancel flag in the same round-trip."""
+    pipe.exists(_cancel_key(task_id))
+    if pipe.execute()[-1]:
+        raise JobCancelled(task_id)
+
+
+def _owns_job(job_id: str, task_id: str) -> bool:
+    """Return True if job:{job_id} still belongs to task_id (no later /generate)."""
+    owner = _get_redis().hget(f"job:{job_id}", "task_id")
+    return owner is not None and owner.decode() == task_id
+
+
 # ── Celery task ───────────────────────────────────────────────────────────────
 
-@celery_app.task(bind=True, name="process_meme")
-def process_meme(self, job_id: str, text: str) -> dict:
+# Progress and results live in the job:{job_id} hash, so nothing is stored in
+# the Celery result backend
+@celery_app.task(bind=True, name="process_meme", ignore_result=True)
+def process_meme(self, job_id: str, text: str, input_path: str) -> dict:
     """
     Run the four pipeline stages for a meme lip-sync job.
 
+    The task's cancel flag is checked on start-up, at every stage boundary
+    and while Wav2Lip runs; a cancelled task stops there, marks the job
+    "cancelled" (unless a newer task has taken the job over) and skips the
+    remaining stages.
+
     Stages
     ------
     1. Preprocess  — GIF/MP4 → normalised MP4
-    2. TTS         — text → 16 kHz mono WAV
+    2. TTS         — text → 16 kHz mono WAV (concurrently with stage 1)
     3. Lip sync    — Wav2Lip inference
     4. Postprocess — MP4 → optimised GIF
+
+    The worker only ever writes job:{job_id}; input_path comes from the
+    /generate request rather than a Redis read.
     """
-    job_dir = os.path.join(TEMP_DIR, job_id)
-    os.makedirs(job_dir, exist_ok=True)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    task_id = self.request.id
+    try:
+        return _run_pipeline(job_id, text, input_path, task_id)
+    except JobCancelled:
+        if _owns_job(job_id, task_id):
+            _update_state(job_id, "cancelled", 0)
+        logger.info("Task %s for job %s cancelled", task_id, job_id)
+        raise Ignore()
 
-    # Retrieve job state to locate the uploaded file
-    job_state = _get_job_state(job_id)
-    if not job_state:
-        _update_state(job_id, "error", 0, error=f"Job {job_id} not found in Redis.")
-        return {"error": "job not found"}
 
-    input_path = job_state.get("input_path")
+def _run_pipeline(job_id: str, text: str, input_path: str, task_id: str) -> dict:
+    """Body of process_meme; raises JobCancelled when the task is cancelled."""
+    _check_cancelled(task_id)
+
+    # The upload handler created job_dir; config.py ensures OUTPUT_DIR
+    job_dir = os.path.join(TEMP_DIR, job_id)
+
     if not input_path or not os.path.exists(input_path):
         _update_state(job_id, "error", 0, error="Uploaded file not found.")
         return {"error": "input file missing"}
 
-    # ── Stage 1: Preprocess ───────────────────────────────────────────────────
-    try:
-        _update_state(job_id, "preprocessing", 5)
-        preprocess_result = preprocess_video(input_path, job_dir)
-        mp4_path = preprocess_result["mp4_path"]
-        fps = preprocess_result["fps"]
-        video_duration = preprocess_result["duration_seconds"]
-        _update_state(job_id, "preprocessing", 20)
-    except Exception as exc:
-        logger.exception("Preprocess failed for job %s", job_id)
-        _update_state(job_id, "error", 20, error=str(exc))
-        return {"error": str(exc)}
+    # Each stage's closing update is queued on `pipe` and flushed together with
+    # the next stage's opening update: one round-trip per stage boundary
+    pipe = _get_redis().pipeline(transaction=False)
 
-    # ── Stage 2: TTS ─────────────────────────────────────────────────────────
-    try:
-        _update_state(job_id, "tts", 25)
-        wav_path = os.path.join(job_dir, "speech.wav")
-        audio_duration = generate_speech(text, wav_path)
-        _update_state(job_id, "tts", 40)
-    except Exception as exc:
-        logger.exception("TTS failed for job %s", job_id)
-        _update_state(job_id, "error", 25, error=str(exc))
-        return {"error": str(exc)}
+    # ── Stages 1 + 2: Preprocess and TTS ──────────────────────────────────────
+    # TTS does not depend on the preprocessed video, so it runs on a helper
+    # thread while preprocess runs here. Only this thread touches `pipe` and
+    # writes job state, so the two stages never race on Redis.
+    wav_path = os.path.join(job_dir, "speech.wav")
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"tts-{job_id[:8]}") as pool:
+        tts_future = pool.submit(generate_speech, text, wav_path)
+
+        try:
+            _update_state(job_id, "preprocessing", 5)
+            preprocess_result = preprocess_video(input_path, job_dir)
+            mp4_path = preprocess_result["mp4_path"]
+            fps = preprocess_result["fps"]
+            video_duration = preprocess_result["duration_seconds"]
+            face_box = preprocess_result["face_box"]
+            _update_state(job_id, "preprocessing", 20, pipeline=pipe)
+        except Exception as exc:
+            logger.exception("Preprocess failed for job %s", job_id)
+            _update_state(job_id, "error", 20, error=str(exc))
+            return {"error": str(exc)}
+
+        try:
+            _update_state(job_id, "tts", 25, pipeline=pipe)
+            _flush(pipe, task_id)
+            audio_duration = tts_future.result()
+            _update_state(job_id, "tts", 40, pipeline=pipe)
+        except JobCancelled:
+            raise
+        except Exception as exc:
+            logger.exception("TTS failed for job %s", job_id)
+            _update_state(job_id, "error", 25, error=str(exc))
+            return {"error": str(exc)}
 
     # ── Stage 3: Lip sync ─────────────────────────────────────────────────────
     try:
-        _update_state(job_id, "lipsync", 45)
+        _update_state(job_id, "lipsync", 45, pipeline=pipe)
+        _flush(pipe, task_id)
         lipsync_output = os.path.join(job_dir, "lipsync_output.mp4")
-        run_lipsync(mp4_path, wav_path, lipsync_output, job_dir)
-        _update_state(job_id, "lipsync", 75)
+        run_lipsync(
+            mp4_path, wav_path, lipsync_output, job_dir,
+            audio_duration=audio_duration,
+            video_duration=video_duration,
+            face_box=face_box,
+            poll=lambda: _check_cancelled(task_id),
+        )
+        _update_state(job_id, "lipsync", 75, pipeline=pipe)
+    except JobCancelled:
+        raise
     except Exception as exc:
         logger.exception("Lipsync failed for job %s", job_id)
         _update_state(job_id, "error", 45, error=str(exc))
@@ -128,7 +276,8 @@ def process_meme(self, job_id: str, text: str) -> dict:
 
     # ── Stage 4: Postprocess ──────────────────────────────────────────────────
     try:
-        _update_state(job_id, "postprocessing", 80)
+        _update_state(job_id, "postprocessing", 80, pipeline=pipe)
+        _flush(pipe, task_id)
         output_filename = f"{job_id}.gif"
         output_gif_path = os.path.join(OUTPUT_DIR, output_filename)
         convert_to_gif(lipsync_output, output_gif_path, fps)
@@ -136,6 +285,8 @@ def process_meme(self, job_id: str, text: str) -> dict:
         _update_state(job_id, "done", 100, output_url=output_url)
         logger.info("Job %s complete: %s", job_id, output_url)
         return {"output_url": output_url}
+    except JobCancelled:
+        raise
     except Exception as exc:
         logger.exception("Postprocess failed for job %s", job_id)
         _update_state(job_id, "error", 80, error=str(exc))
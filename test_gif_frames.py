@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Regression test: GIF→MP4 conversion keeps every frame of a uniform GIF."""
+
+import os
+import sys
+import tempfile
+
+import av
+from PIL import Image
+
+from backend.pipeline.preprocess import _gif_to_mp4
+
+FRAME_COUNT = 12
+FRAME_DELAY_MS = 100  # 10 fps; 0.1 s is not exact in floating point
+FPS = 10.0
+
+
+def make_gif(path):
+    # Distinct red levels so each output frame can be traced to its source
+    frames = [
+        Image.new("RGB", (64, 64), (i * 20, 128, 128)) for i in range(FRAME_COUNT)
+    ]
+    frames[0].save(
+        path, save_all=True, append_images=frames[1:], duration=FRAME_DELAY_MS, loop=0,
+    )
+
+
+def red_levels(mp4_path):
+    with av.open(mp4_path) as container:
+        return [
+            round(frame.to_ndarray(format="rgb24")[..., 0].mean() / 20)
+            for frame in container.decode(video=0)
+        ]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        gif_path = os.path.join(tmp, "uniform.gif")
+        mp4_path = os.path.join(tmp, "uniform.mp4")
+        make_gif(gif_path)
+        _gif_to_mp4(gif_path, mp4_path, FPS)
+        levels = red_levels(mp4_path)
+
+    expected = list(range(FRAME_COUNT))
+    if levels != expected:
+        print(f"[FAIL] frames {levels}, expected {expected}")
+        sys.exit(1)
+    print(f"[PASS] {FRAME_COUNT} distinct frames at {FPS:g} fps")
+
+
+if __name__ == "__main__":
+    main()